@@ -1,53 +1,69 @@
 import argparse
-import json
-import datetime
+import os
 import sys
-from typing import Any, Dict, List  # noqa
+import urllib.parse
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List  # noqa
 
-from bitcoinrpc.authproxy import AuthServiceProxy
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
 
 DIFFICULTY_INTERVAL = 2016
 
-
-class BlockFetcher:
-    """Block iterator that batches RPC calls."""
-
-    def __init__(self,
-                 rpc_connection: AuthServiceProxy,
-                 scan_coinbase=False,
-                 batch_size=100) -> None:
-        self.rpc_connection = rpc_connection
-        self.height = 0
-        self.blocks = []  # type: List[Dict[str, Any]]
-        self.scan_coinbase = scan_coinbase
-        self.batch_size = batch_size
-
-    def _fetch_blocks(self):
-        assert self.blocks == []
-        block_hashes = self.rpc_connection.batch_(
-            ['getblockhash', h]
-            for h in range(self.height, self.height + self.batch_size))
-        self.height += self.batch_size
-        if self.scan_coinbase:
-            commands = (['getblock', h, 2] for h in block_hashes)
-        else:
-            commands = (['getblock', h] for h in block_hashes)
-        self.blocks = self.rpc_connection.batch_(commands)
-
-    def __iter__(self):
-        assert self.height == 0
-        return self
-
-    def __next__(self):
-        if not self.blocks:
-            self._fetch_blocks()
-        return self.blocks.pop(0)
-
-
-def block_time(block: Dict[str, Any]) -> datetime.datetime:
-    """Get the datetime for a block."""
-    unix_time = int(block['time'])
-    return datetime.datetime.fromtimestamp(unix_time)
+# Satoshis per bitcoin.
+COIN = 100000000
+
+# Expected number of hashes to find a block at difficulty 1.
+HASHES_PER_DIFFICULTY = (1 << 48) / 0xffff
+
+
+class RpcError(Exception):
+    """An error returned by bitcoind for an RPC call."""
+
+
+class PooledRpc:
+    """JSON-RPC client that reuses HTTP connections across batches."""
+
+    def __init__(self, url: str, pool_size=1, timeout=30) -> None:
+        self.timeout = timeout
+        parts = urllib.parse.urlsplit(url)
+        netloc = parts.netloc.rpartition('@')[2]
+        self.url = urllib.parse.urlunsplit(parts._replace(netloc=netloc))
+        self.session = requests.Session()
+        self.session.mount(
+            parts.scheme + '://',
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        if parts.username is not None:
+            self.session.auth = HTTPBasicAuth(
+                urllib.parse.unquote(parts.username),
+                urllib.parse.unquote(parts.password or ''))
+
+    def batch_(self, commands: Iterable[List[Any]]) -> List[Any]:
+        """Send a batch of RPC calls in a single request."""
+        payload = [{
+            'jsonrpc': '1.0',
+            'id': i,
+            'method': command[0],
+            'params': command[1:],
+        } for i, command in enumerate(commands)]
+        response = self.session.post(
+            self.url,
+            data=orjson.dumps(payload),
+            headers={'Content-Type': 'application/json'},
+            timeout=self.timeout)
+        response.raise_for_status()
+        results = []
+        for reply in orjson.loads(response.content):
+            if reply['error'] is not None:
+                raise RpcError(reply['error'])
+            results.append(reply['result'])
+        return results
+
+
+def block_time(block: Dict[str, Any]) -> int:
+    """Get the Unix timestamp for a block."""
+    return int(block['time'])
 
 
 def estimate_hash_rate(difficulty: float, seconds: float) -> float:
@@ -55,16 +71,66 @@ def estimate_hash_rate(difficulty: float, seconds: float) -> float:
 
     This uses the algorithm described at https://en.bitcoin.it/wiki/Difficulty.
     """
-    expected_hashes = difficulty * (1 << 48) / 0xffff
-    return expected_hashes / seconds
-
-
-def block_reward(block: Dict[str, Any]) -> float:
-    """Get the block reward at a given height."""
-    for tx in block['tx']:
-        if any('coinbase' in vin for vin in tx['vin']):
-            return sum(float(vout['value']) for vout in tx['vout'])
-    assert False  # not reached
+    return difficulty * HASHES_PER_DIFFICULTY / seconds
+
+
+def block_reward(stats: Dict[str, Any]) -> float:
+    """Get the block reward from the block's getblockstats result."""
+    return (stats['subsidy'] + stats['totalfee']) / COIN
+
+
+def period_info(start_block: Dict[str, Any],
+                end_block: Dict[str, Any]) -> Dict[str, Any]:
+    """Summarize the difficulty period between two boundary blocks."""
+    start_time = block_time(start_block)
+    elapsed_time = block_time(end_block) - start_time
+    block_interval = elapsed_time / DIFFICULTY_INTERVAL
+    hash_rate = estimate_hash_rate(
+        float(start_block['difficulty']), block_interval)
+    return {
+        'height': int(end_block['height']),
+        'start': start_time,
+        'hashrate': hash_rate,
+        'interval': block_interval,
+    }
+
+
+def boundary_periods(rpc_connection: PooledRpc,
+                     periods: int,
+                     mining_rewards=False) -> Iterator[Dict[str, Any]]:
+    """Yield period info using only the first block of each period."""
+    tip = rpc_connection.batch_([['getblockcount']])[0]
+    # At least one period is always reported, as the old full block scan did.
+    last_height = min(max(periods, 1) * DIFFICULTY_INTERVAL, tip)
+    heights = range(0, last_height + 1, DIFFICULTY_INTERVAL)
+    block_hashes = rpc_connection.batch_(['getblockhash', h] for h in heights)
+    commands = [['getblockheader', h] for h in block_hashes]
+    if mining_rewards:
+        # The reward reported for a period is that of the block that ends it,
+        # so the genesis block never needs getblockstats (which older bitcoind
+        # versions can't compute for it).
+        commands.extend(
+            ['getblockstats', h, ['subsidy', 'totalfee']]
+            for h in block_hashes[1:])
+    results = rpc_connection.batch_(commands)
+    headers = results[:len(block_hashes)]
+    all_stats = results[len(block_hashes):]
+    for i, (start_block, end_block) in enumerate(zip(headers, headers[1:])):
+        data = period_info(start_block, end_block)
+        if mining_rewards:
+            data['reward'] = block_reward(all_stats[i])
+        yield data
+
+
+def write_periods(outfile: BinaryIO,
+                  periods: Iterable[Dict[str, Any]]) -> None:
+    """Write period info to outfile as a JSON array."""
+    outfile.write(b'[')
+    for i, data in enumerate(periods):
+        if i:
+            outfile.write(b',')
+        outfile.write(orjson.dumps(data))
+    outfile.write(b']\n')
 
 
 def main():
@@ -84,40 +150,24 @@ def main():
     parser.add_argument('url')
     args = parser.parse_args()
 
-    info = []
-    rpc_connection = AuthServiceProxy(args.url)
-    for block in BlockFetcher(rpc_connection, args.mining_rewards):
-        height = int(block['height'])
-        if height == 0:
-            prev_block = block
-            prev_time = block_time(block)
-            reward = 0
-        elif height % DIFFICULTY_INTERVAL == 0:
-            cur_time = block_time(block)
-            elapsed_time = (cur_time - prev_time).total_seconds()
-            block_interval = elapsed_time / DIFFICULTY_INTERVAL
-            hash_rate = estimate_hash_rate(
-                float(prev_block['difficulty']), block_interval)
-            data = {
-                'height': height,
-                'start': int(prev_time.timestamp()),
-                'hashrate': hash_rate,
-                'interval': block_interval,
-            }
-            if args.mining_rewards:
-                data['reward'] = block_reward(block)
-                reward = 0.
-            info.append(data)
-            if len(info) >= args.periods:
-                break
-            prev_block = block
-            prev_time = cur_time
-        if args.mining_rewards:
-            reward += block_reward(block)
-
-    outfile = open(args.output, 'w') if args.output else sys.stdout
-    json.dump(info, outfile)
-    outfile.write('\n')
+    rpc_connection = PooledRpc(args.url)
+    periods = boundary_periods(
+        rpc_connection, args.periods, args.mining_rewards)
+
+    if not args.output:
+        write_periods(sys.stdout.buffer, periods)
+        return
+    # Write to a temporary file first so that a failed run doesn't leave a
+    # truncated array behind.
+    partial = args.output + '.partial'
+    with open(partial, 'wb') as outfile:
+        try:
+            write_periods(outfile, periods)
+        except BaseException:
+            outfile.close()
+            os.remove(partial)
+            raise
+    os.replace(partial, args.output)
 
 
 if __name__ == '__main__':